@@ -0,0 +1,222 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from itertools import count
+
+
+class StageTimer:
+    """
+    timestamps stages of a single request with a monotonic clock,
+    every mark() adds the time elapsed since the previous mark to the stage,
+    finish() hands all stages of the request to stats at once
+    """
+    def __init__(self, stats, started):
+        self._stats = stats
+        self._last = started
+        self._stages = {}
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self._stages[stage] = self._stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        self._stats.record_all(self._stages)
+
+
+class NullStageTimer:
+    def mark(self, stage):
+        pass
+
+    def finish(self):
+        pass
+
+
+class NullStageStats:
+    # used when profiling is off, so client_worker pays for a no-op call only
+    _timer = NullStageTimer()
+
+    def start(self, started=None):
+        return self._timer
+
+    def record_all(self, stages):
+        pass
+
+    def report(self):
+        return "Stage profiling is disabled"
+
+
+class StageHistogram:
+    """
+    log-linear buckets in microseconds: values below SUB_BUCKETS us are exact,
+    every larger power of two is split into SUB_BUCKETS equal sub-buckets,
+    so a percentile (reported as its bucket upper bound) overestimates
+    the real value by at most 1 / SUB_BUCKETS, i.e. 12.5%
+    """
+    SUB_BUCKETS = 8
+    SUB_BITS = 3
+    BUCKETS = SUB_BUCKETS * 30
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def bucket_of(cls, micros):
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 1 - cls.SUB_BITS
+        bucket = cls.SUB_BUCKETS * (shift + 1) + (micros >> shift) - cls.SUB_BUCKETS
+        return min(bucket, cls.BUCKETS - 1)
+
+    @classmethod
+    def upper_bound(cls, bucket):
+        # smallest value in microseconds above every value of the bucket
+        if bucket < cls.SUB_BUCKETS:
+            return bucket + 1
+        shift, sub = divmod(bucket, cls.SUB_BUCKETS)
+        return (cls.SUB_BUCKETS + sub + 1) << (shift - 1)
+
+    def add(self, elapsed):
+        self.counts[self.bucket_of(int(elapsed * 1e6))] += 1
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, in seconds
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= threshold:
+                return min(self.upper_bound(bucket) / 1e6, self.max)
+        return self.max
+
+
+class StageStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = OrderedDict()
+
+    def start(self, started=None):
+        return StageTimer(self, time.monotonic() if started is None else started)
+
+    def record_all(self, stages):
+        with self._lock:
+            for stage, elapsed in stages.items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = StageHistogram()
+                histogram.add(elapsed)
+
+    def report(self):
+        lines = ['{:<14}{:>10}{:>12}{:>12}{:>12}{:>12}'.format(
+            'stage', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+        with self._lock:
+            for stage, h in self.histograms.items():
+                lines.append('{:<14}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+                    stage, h.count, h.total / h.count * 1e3, h.percentile(50) * 1e3,
+                    h.percentile(99) * 1e3, h.max * 1e3))
+        return '\n'.join(lines)
+
+
+class SamplingProfiler:
+    """
+    samples stacks of all running threads from a background thread and
+    writes them in collapsed format ("frame;frame;frame count"), which is
+    accepted by flamegraph.pl and speedscope;
+    start()/stop() only spawn or signal the sampler thread, so they are
+    safe to call from a signal handler, the file is written by the sampler
+    """
+    def __init__(self, interval=0.005, output_dir='.'):
+        self.interval = interval
+        self.output_dir = output_dir
+        self._stop = None
+        self._sessions = count(1)
+
+    @property
+    def running(self):
+        return self._stop is not None
+
+    def start(self):
+        if self.running:
+            return
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, args=(self._stop,),
+                         name='sampling-profiler', daemon=True).start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._stop = None
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self, stop):
+        print("Sampling profiler started")
+        samples = Counter()
+        own_id = threading.get_ident()
+        while not stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    samples[self._collapse(frame)] += 1
+        try:
+            path = self.dump(samples)
+        except OSError as e:
+            print("Sampling profiler stopped, could not write stacks: {}".format(e))
+        else:
+            print("Sampling profiler stopped, stacks written to {}".format(path))
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def dump(self, samples):
+        # session number keeps dumps finished within one second apart,
+        # 'x' mode guarantees an existing profile is never overwritten
+        path = os.path.join(self.output_dir, 'dns-cache-{}-{}-{}.folded'.format(
+            os.getpid(), int(time.time()), next(self._sessions)))
+        with open(path, 'x') as output:
+            for stack, count in samples.most_common():
+                output.write('{} {}\n'.format(stack, count))
+        return path
+
+
+def install_signal_handlers(stats, profiler):
+    """
+    SIGUSR1 toggles the sampling profiler (stacks are dumped when it stops),
+    SIGUSR2 prints per-stage latency histograms;
+    output is left to other threads to keep printing out of signal context,
+    must be called from the main thread
+    """
+    if not hasattr(signal, 'SIGUSR1'):
+        return False
+
+    def toggle_profiler(signum, frame):
+        profiler.toggle()
+
+    def report_stages(signum, frame):
+        threading.Thread(target=lambda: print(stats.report()), daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, toggle_profiler)
+    signal.signal(signal.SIGUSR2, report_stages)
+    return True
@@ -1,12 +1,14 @@
 import socket
 import sys
 import argparse
+import time
 from cache import DnsCache
 from itertools import zip_longest
 from multiprocessing.dummy import Pool as ThreadPool
 from select import select
 from threading import Lock
 from packets import DNS_Packet, dns_types
+from profiling import NullStageStats, SamplingProfiler, StageStats, install_signal_handlers
 
 
 class DnsServer:
@@ -20,6 +22,8 @@ class DnsServer:
         self._lock = Lock()
         self._unprocessed_questions = set()
         self._RD = 1
+        self.stats = NullStageStats()
+        self.profiler = SamplingProfiler()
 
     def set_up_address(self, address='localhost'):
         self.address = address
@@ -56,6 +60,11 @@ class DnsServer:
             self.pool = ThreadPool(processes=4)
         return self
 
+    def set_up_profiling(self, enabled=True, output_dir='.'):
+        self.stats = StageStats() if enabled else NullStageStats()
+        self.profiler = SamplingProfiler(output_dir=output_dir)
+        return self
+
     def __check_all_set_up__(self):
         values = self.__dict__
         for k, v in values.items():
@@ -70,19 +79,31 @@ class DnsServer:
         else:
             return True
 
-    def client_worker(self, request, connection):
+    def client_worker(self, request, connection, received=None):
         """
         a function to work with client - form answering packet and send it
         :param
         request is a Tuple : binary_data and address
         binary_data converted to string domain name: google.com, www.vk.com or common
         and address - sending dns reply to a client
+        received is a monotonic timestamp of the moment request was read from socket
         """
+        timer = self.stats.start(received)
+        if received is not None:
+            timer.mark('queue')
+        try:
+            self._answer_client(request, connection, timer)
+        finally:
+            timer.finish()
+
+    def _answer_client(self, request, connection, timer):
         bin_data, address = request
         query = DNS_Packet.parse(bin_data)
+        timer.mark('parse')
         query_questions = frozenset(query.questions)
         if query_questions in self._unprocessed_questions:
             self._send_server_failure_response(query, connection, address)
+            timer.mark('servfail')
             return
         self._unprocessed_questions.add(query_questions)
         answers = []
@@ -90,21 +111,30 @@ class DnsServer:
         additional = []
         for question in query.questions:
             cache_result, c_authority, c_additional = self.cache.process_query(question)
+            timer.mark('cache')
             if not cache_result:
                 replies = self.ask_forwarder(question)
+                timer.mark('forwarder')
                 if not replies:
                     self._send_server_failure_response(query, connection, address)
+                    timer.mark('servfail')
                     return
                 print('{}, {}, {}, {}'.format(address[0], dns_types[question.type], question.name, 'forwarder'))
-                self._process_forwarder_replies(replies, query, connection, address)
+                timer.mark('log')
+                self._process_forwarder_replies(replies, query, connection, address, timer)
                 self._unprocessed_questions.remove(query_questions)
                 return
             answers.extend(cache_result)
             authority.extend(c_authority)
             additional.extend(c_additional)
             print('{}, {}, {}, {}'.format(address[0], dns_types[question.type], question.name, 'cache'))
+            timer.mark('log')
         reply = DNS_Packet.build_reply(query, answers, authority, additional)
-        connection.sendto(reply.to_raw_packet(), address)
+        timer.mark('build')
+        raw_reply = reply.to_raw_packet()
+        timer.mark('serialize')
+        connection.sendto(raw_reply, address)
+        timer.mark('send')
         self._unprocessed_questions.remove(query_questions)
 
     def _send_server_failure_response(self, query, connection, address):
@@ -119,12 +149,16 @@ class DnsServer:
     def _without_errors(forwarder_reply):
         return forwarder_reply.flags.rcode == DNS_Packet.RCODES['No error']
 
-    def _process_forwarder_replies(self, replies, query, connection, address):
+    def _process_forwarder_replies(self, replies, query, connection, address, timer):
         for reply in replies:
             reply.id = query.id
-            connection.sendto(reply.to_raw_packet(), address)
+            raw_reply = reply.to_raw_packet()
+            timer.mark('fwd_serialize')
+            connection.sendto(raw_reply, address)
+            timer.mark('fwd_send')
             if self._without_errors(reply):
                 self._insert_reply_into_cache(reply)
+                timer.mark('fwd_insert')
 
     def ask_forwarder(self, query):
         results = []
@@ -152,6 +186,8 @@ class DnsServer:
     def launch(self):
         self.__check_all_set_up__()
         print(self.welcome)
+        if install_signal_handlers(self.stats, self.profiler):
+            print("Profiling: SIGUSR1 toggles stack sampling, SIGUSR2 prints stage latencies")
         connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.__try_bind_connection__(connection)
         while True:
@@ -162,13 +198,17 @@ class DnsServer:
                 except socket.error:
                     print("Couldn't receive from client")
                 else:
-                    self.pool.apply_async(self.client_worker, args=[question, connection])
+                    self.pool.apply_async(self.client_worker,
+                                          args=[question, connection, time.monotonic()])
 
 
 def create_parser():
     parser = argparse.ArgumentParser(description='Caching DNS server')
     parser.add_argument('-p', '--port', type=int, default=53, help='listening udp port')
     parser.add_argument('-f', '--forwarder', default='8.8.8.8', help='dns forwarder[:port]')
+    parser.add_argument('--profile', action='store_true',
+                        help='collect per-stage request latencies '
+                             '(reported percentiles overestimate by at most 12.5%%)')
     return parser
 
 
@@ -178,4 +218,4 @@ if __name__ == '__main__':
     port = args.port
     params = dict(zip_longest(['forwarder', 'port'], args.forwarder.split(':'), fillvalue=port))
     server = DnsServer('Hello').set_up_address().set_up_port(int(params['port'])).set_up_forwarder(params['forwarder'])
-    server.apply_async().set_up_cache().launch()
+    server.apply_async().set_up_cache().set_up_profiling(args.profile).launch()